@@ -1,9 +1,7 @@
 #!/usr/bin/python3
 
-import json
 import os
 from pathlib import Path
-import re
 import shutil
 import subprocess
 from subprocess import check_call
@@ -11,16 +9,26 @@ import sys
 import tempfile
 from typing import Any, Dict
 
+import orjson
+
 
 # Based on code (with the same author) at:
 # https://pagure.io/flatpak-module-tools/blob/master/f/flatpak_module_tools/flatpak_builder.py
 
 
-def get_path_from_descriptor(base: Path, descriptor: Dict[str, Any]):
-    assert descriptor["digest"].startswith("sha256:")
-    return os.path.join(
-        base, "blobs", "sha256", descriptor["digest"][len("sha256:"):]
-    )
+def load_json(path: Path):
+    return orjson.loads(Path(path).read_bytes())
+
+
+def blob_path(base: Path, descriptor: Dict[str, Any]):
+    digest = descriptor["digest"]
+    assert digest[:7] == "sha256:"
+    return base / f"blobs/sha256/{digest[7:]}"
+
+
+def check_call_quiet(args):
+    # Progress output isn't interesting, errors still go to stderr
+    subprocess.run(args, check=True, stdout=subprocess.DEVNULL)
 
 
 def make_single_arch_copy(source_path: Path, dest_path: Path):
@@ -34,31 +42,24 @@ def make_single_arch_copy(source_path: Path, dest_path: Path):
         f"oci:{dest_path}"
     ])
 
-    with open(source_path / "index.json", "rb") as f:
-        old_index_json = json.load(f)
+    old_index_json = load_json(source_path / "index.json")
+    image_index_json = load_json(blob_path(source_path, old_index_json['manifests'][0]))
 
-    with open(get_path_from_descriptor(source_path, old_index_json['manifests'][0])) as f:
-        image_index_json = json.load(f)
-
-    with open(dest_path / "index.json", "rb") as f:
-        new_index_json = json.load(f)
-
-    with open(get_path_from_descriptor(dest_path, new_index_json["manifests"][0]), "r") as f:
-        new_manifest_json = json.load(f)
-    with open(get_path_from_descriptor(dest_path, new_manifest_json["config"]), "r") as f:
-        config = json.load(f)
+    new_index_json = load_json(dest_path / "index.json")
+    new_manifest_json = load_json(blob_path(dest_path, new_index_json["manifests"][0]))
+    config = load_json(blob_path(dest_path, new_manifest_json["config"]))
     architecture = config["architecture"]
 
     for manifest in image_index_json["manifests"]:
         if manifest["platform"]["architecture"] == architecture:
-            src = get_path_from_descriptor(source_path, manifest)
-            dest = get_path_from_descriptor(dest_path, manifest)
+            src = blob_path(source_path, manifest)
+            dest = blob_path(dest_path, manifest)
             shutil.copyfile(src, dest)
             new_index_json["manifests"] = [manifest]
             break
 
-    with open(dest_path / "index.json", "w") as f:
-        json.dump(new_index_json, f, indent=4)
+    with open(dest_path / "index.json", "wb") as f:
+        f.write(orjson.dumps(new_index_json, option=orjson.OPT_INDENT_2))
 
 
 class Installer:
@@ -75,21 +76,19 @@ class Installer:
             if not os.path.exists(parent):
                 os.makedirs(parent)
 
-            check_call(['ostree', 'init', '--mode=archive-z2', '--repo', self.repodir])
-            check_call(['flatpak', 'build-update-repo', self.repodir])
+            check_call_quiet(['ostree', 'init', '--mode=archive-z2', '--repo', self.repodir])
+            check_call_quiet(['flatpak', 'build-update-repo', self.repodir])
 
         output = subprocess.check_output(['flatpak', 'remotes', '--user'], encoding="UTF-8")
-        if not re.search(r'^flatpak-module-tools\s', output, re.MULTILINE):
-            check_call(['flatpak', 'remote-add',
-                        '--user', '--no-gpg-verify',
-                        'flatpak-module-tools', self.repodir])
+        remotes = {line.split(None, 1)[0] for line in output.splitlines() if line.strip()}
+        if 'flatpak-module-tools' not in remotes:
+            check_call_quiet(['flatpak', 'remote-add',
+                              '--user', '--no-gpg-verify',
+                              'flatpak-module-tools', self.repodir])
 
     def _install_from_path(self, source_path: Path):
-        with open(os.path.join(source_path, 'index.json')) as f:
-            index_json = json.load(f)
-
-        with open(get_path_from_descriptor(source_path, index_json['manifests'][0])) as f:
-            manifest_json = json.load(f)
+        index_json = load_json(os.path.join(source_path, 'index.json'))
+        manifest_json = load_json(blob_path(source_path, index_json['manifests'][0]))
 
         if manifest_json["mediaType"] == "application/vnd.oci.image.index.v1+json":
             # multi-arch bundle, Flatpak doesn't support this, make a single-arch copy
@@ -98,40 +97,38 @@ class Installer:
                 self._install_from_path(Path(td))
                 return
 
-        with open(get_path_from_descriptor(source_path, manifest_json["config"])) as f:
-            config_json = json.load(f)
-
-            config = config_json.get("config", {})
-            labels = config.get("Labels", {})
+        config_json = load_json(blob_path(source_path, manifest_json["config"]))
+        config = config_json.get("config", {})
+        labels = config.get("Labels", {})
 
-            ref = labels.get('org.flatpak.ref')
+        ref = labels.get('org.flatpak.ref')
 
         if ref is None:
             raise RuntimeError(
                 "org.flatpak.ref not found in annotations or labels - is this a Flatpak?"
             )
 
-        check_call(['flatpak', 'build-import-bundle',
-                    '--update-appstream', '--oci',
-                    '--ref', ref,
-                    self.repodir, source_path])
+        check_call_quiet(['flatpak', 'build-import-bundle',
+                          '--update-appstream', '--oci',
+                          '--ref', ref,
+                          self.repodir, source_path])
 
         parts = ref.split('/')
         shortref = parts[0] + '/' + parts[1]
 
         try:
-            with open(os.devnull, 'w') as devnull:
-                old_origin = subprocess.check_output(['flatpak', 'info', '--user', '-o', shortref],
-                                                     stderr=devnull, encoding="UTF-8").strip()
+            old_origin = subprocess.check_output(['flatpak', 'info', '--user', '-o', shortref],
+                                                 stderr=subprocess.DEVNULL,
+                                                 encoding="UTF-8").strip()
         except subprocess.CalledProcessError:
             old_origin = None
 
         if old_origin == 'flatpak-module-tools':
-            check_call([
+            check_call_quiet([
                 'flatpak', 'update', '-y', '--user', ref
             ])
         else:
-            check_call([
+            check_call_quiet([
                 'flatpak', 'install', '-y', '--user', '--reinstall', 'flatpak-module-tools', ref
             ])
 
@@ -1,15 +1,20 @@
 #!/usr/bin/python3
 
+from concurrent.futures import ThreadPoolExecutor
+import errno
 import hashlib
-import json
+import io
 import os
 from pathlib import Path
 import shutil
+import subprocess
 from subprocess import check_call
 import tarfile
 import tempfile
 from textwrap import dedent
-from typing import Any, Callable, Dict
+from typing import Any, Callable, Dict, Optional, Union
+
+import orjson
 
 
 # Based on code (with the same author) at:
@@ -20,10 +25,15 @@ def header(str):
     print(f"\033[1m{str}\033[0m")
 
 
+def check_call_quiet(args):
+    # Progress output isn't interesting, errors still go to stderr
+    subprocess.run(args, check=True, stdout=subprocess.DEVNULL)
+
+
 def create_oci(workdir: Path,
                ref: str,
                metadata: str,
-               add_files: Callable[[Path], None]):
+               add_files: Callable[[Path], Optional[Path]]):
     prefix, name, arch, branch = ref.split("/")
     is_runtime = prefix == "runtime"
 
@@ -36,15 +46,18 @@ def create_oci(workdir: Path,
     filesdir = builddir / "files"
     filesdir.mkdir(parents=True)
 
-    repo = workdir / "repo"
-    check_call(["ostree", "init", "--mode=archive-z2", "--repo", repo])
+    # Separate repositories so that images for different architectures can be built in parallel
+    repo = workdir / f"repo-{name}-{arch}"
+    check_call_quiet(["ostree", "init", "--mode=archive-z2", "--repo", repo])
 
     with open(builddir / "metadata", "w") as f:
         f.write(metadata)
 
-    add_files(filesdir)
+    # add_files() can populate filesdir, and can also return a tarfile, with paths
+    # relative to builddir, that ostree commits on top of it
+    files_tar = add_files(filesdir)
 
-    check_call([
+    check_call_quiet([
         "flatpak", "build-finish", builddir
     ])
 
@@ -58,12 +71,14 @@ def create_oci(workdir: Path,
                    "-s", "build of " + ref,
                    f"--tree=dir={builddir}",
                    "--add-metadata-string", "xa.metadata=" + metadata]
+    if files_tar is not None:
+        commit_args.append(f"--tree=tar={files_tar}")
 
-    check_call(["ostree", "commit"] + commit_args)
-    check_call(["ostree", "summary", "-u", "--repo", repo])
+    check_call_quiet(["ostree", "commit"] + commit_args)
+    check_call_quiet(["ostree", "summary", "-u", "--repo", repo])
 
     runtime_arg = ["--runtime"] if is_runtime else []
-    check_call([
+    check_call_quiet([
         "flatpak", "build-bundle", repo,
         "--oci"
     ] + runtime_arg + [
@@ -89,12 +104,45 @@ def create_runtime_oci(workdir: Path, arch: str, contents_tar: Path):
     def add_files(filesdir: Path):
         # The Flatpak code to create an OCI doesn't handle hard-links efficiently,
         # so we only include /bin/sh and not all the other files in /bin
-        # (otherwise we could just use tf.extractall())
-        tf = tarfile.open(contents_tar, "r:gz")
-        for member in tf:
-            if member.name.startswith("bin/") and member.name != "bin/sh":
-                continue
-            tf.extract(member, filesdir)
+        # (otherwise we could just commit the layer directly)
+        #
+        # Rather than extracting the layer, we write a filtered copy with the paths
+        # moved under files/ for ostree to commit. The layer is read in streaming
+        # mode, so we can't go back to get the contents of a hard-link target we
+        # skipped - instead, keep the contents of the regular files in /bin, and
+        # write /bin/sh out as a regular file.
+        files_tar = workdir / f"files-{name}-{arch}.tar"
+        bin_contents: Dict[str, bytes] = {}
+        with tarfile.open(contents_tar, "r|gz") as src, tarfile.open(files_tar, "w") as dest:
+            for member in src:
+                if member.name.startswith("bin/") and member.name != "bin/sh":
+                    if member.isreg():
+                        bin_contents[member.name] = src.extractfile(member).read()
+                    continue
+
+                # When the member is written, values in pax_headers (as read from
+                # the layer for long or non-ASCII names) take precedence over the
+                # attributes we change below, so drop them; tarfile regenerates
+                # them from the attributes as needed.
+                for key in ("path", "linkpath", "size"):
+                    member.pax_headers.pop(key, None)
+
+                fileobj = None
+                if member.islnk() and member.linkname in bin_contents:
+                    contents = bin_contents[member.linkname]
+                    member.type = tarfile.REGTYPE
+                    member.linkname = ""
+                    member.size = len(contents)
+                    fileobj = io.BytesIO(contents)
+                elif member.isreg():
+                    fileobj = src.extractfile(member)
+                elif member.islnk():
+                    member.linkname = "files/" + member.linkname
+
+                member.name = "files/" + member.name
+                dest.addfile(member, fileobj)
+
+        return files_tar
 
     return create_oci(workdir, ref, metadata, add_files)
 
@@ -127,19 +175,30 @@ def create_app_oci(workdir: Path, arch: str):
 
 
 def load_json(path: Path):
-    with open(path, "r") as f:
-        return json.load(f)
+    return orjson.loads(Path(path).read_bytes())
 
 
 def blob_path(base: Path, descriptor: Dict[str, Any]):
-    assert descriptor["digest"][:7] == "sha256:"
-    return base / "blobs/sha256" / descriptor["digest"][7:]
+    digest = descriptor["digest"]
+    assert digest[:7] == "sha256:"
+    return base / f"blobs/sha256/{digest[7:]}"
 
 
 def load_json_blob(base: Path, digest):
     return load_json(blob_path(base, digest))
 
 
+def link_or_copy(src: Union[str, Path], dest: Path):
+    # Blobs are content-addressed and never modified, so sharing an inode is safe;
+    # fall back to copying when the source is on a different filesystem
+    try:
+        os.link(src, dest)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copyfile(src, dest)
+
+
 def make_multiarch_image(output_dir: Path, images: Dict[str, Path]):
     header(f"Creating multi-arch image at {output_dir}")
 
@@ -152,8 +211,8 @@ def make_multiarch_image(output_dir: Path, images: Dict[str, Path]):
         "imageLayoutVersion": "1.0.0"
     }
 
-    with open(output_dir / "oci-layout", "w") as f:
-        json.dump(image_layout, f, indent=4)
+    with open(output_dir / "oci-layout", "wb") as f:
+        f.write(orjson.dumps(image_layout, option=orjson.OPT_INDENT_2))
 
     image_index = {
         "schemaVersion": 2,
@@ -161,9 +220,16 @@ def make_multiarch_image(output_dir: Path, images: Dict[str, Path]):
         "manifests": []
     }
 
+    # The same blob can appear in the images for multiple architectures
+    copied_blobs = set()
+
     for _, input_dir in images.items():
-        for blob in (input_dir / "blobs/sha256").iterdir():
-            shutil.copyfile(blob, blobs_dir / blob.name)
+        with os.scandir(input_dir / "blobs/sha256") as it:
+            for entry in it:
+                if entry.name in copied_blobs:
+                    continue
+                link_or_copy(entry.path, blobs_dir / entry.name)
+                copied_blobs.add(entry.name)
 
         input_image_index = load_json(input_dir / "index.json")
         manifest_descriptor = input_image_index["manifests"][0]
@@ -178,7 +244,7 @@ def make_multiarch_image(output_dir: Path, images: Dict[str, Path]):
 
         image_index["manifests"].append(output_descriptor)
 
-    image_index_contents = json.dumps(image_index, indent=4).encode("utf8")
+    image_index_contents = orjson.dumps(image_index, option=orjson.OPT_INDENT_2)
     image_index_digest = hashlib.sha256(image_index_contents).hexdigest()
 
     with open(output_dir / "blobs/sha256" / image_index_digest, "wb") as f:
@@ -190,12 +256,12 @@ def make_multiarch_image(output_dir: Path, images: Dict[str, Path]):
         "manifests": [{
             "mediaType": "application/vnd.oci.image.index.v1+json",
             "digest": "sha256:" + image_index_digest,
-            "size": len(image_index_digest)
+            "size": len(image_index_contents)
         }]
     }
 
-    with open(output_dir / "index.json", "w") as f:
-        json.dump(archive_index, f, indent=4)
+    with open(output_dir / "index.json", "wb") as f:
+        f.write(orjson.dumps(archive_index, option=orjson.OPT_INDENT_2))
 
 
 def main(workdir: Path):
@@ -227,9 +293,20 @@ def main(workdir: Path):
         manifest = load_json_blob(busybox, descriptor)
         contents_tars[flatpak_arch] = blob_path(busybox, manifest["layers"][0])
 
-    for flatpak_arch, contents_tar in contents_tars.items():
-        runtimes[flatpak_arch] = create_runtime_oci(workdir, flatpak_arch, contents_tar)
-        apps[flatpak_arch] = create_app_oci(workdir, flatpak_arch)
+    # The builds mostly wait on ostree and flatpak subprocesses, so threads are enough.
+    # Output from the builds for different architectures will be interleaved.
+    with ThreadPoolExecutor(max_workers=max(1, 2 * len(contents_tars))) as executor:
+        runtime_futures = {}
+        app_futures = {}
+        for flatpak_arch, contents_tar in contents_tars.items():
+            runtime_futures[flatpak_arch] = executor.submit(
+                create_runtime_oci, workdir, flatpak_arch, contents_tar
+            )
+            app_futures[flatpak_arch] = executor.submit(create_app_oci, workdir, flatpak_arch)
+
+        for flatpak_arch in contents_tars:
+            runtimes[flatpak_arch] = runtime_futures[flatpak_arch].result()
+            apps[flatpak_arch] = app_futures[flatpak_arch].result()
 
     make_multiarch_image(Path("oci-net.fishsoup.BusyBoxPlatform"), runtimes)
     make_multiarch_image(Path("oci-net.fishsoup.Hello"), apps)